@@ -26,6 +26,8 @@ async def main():
             print(f"Available tools: {tool_names}")
             assert "send_command" in tool_names, "send_command tool not found!"
             assert "clear_kernel" in tool_names, "clear_kernel tool not found!"
+            assert "send_commands" in tool_names, "send_commands tool not found!"
+            assert "send_chained_commands" in tool_names, "send_chained_commands tool not found!"
             print("send_command and clear_kernel tools found. Test 1 PASSED.")
 
             # 2. Send a command to define a variable and print it
@@ -121,7 +123,8 @@ async def main():
             print(f"Result of multi-line command with expression:\n{actual_text_output4}")
             assert "Status: ok" in actual_text_output4, f"Status was not 'ok' for expression command. Got: '{actual_text_output4}'"
             # IPython's execute_result for an expression 'z' would show '20'
-            assert "Result: 20" in actual_text_output4 or "Out[1]: 20" in actual_text_output4 or "20" in actual_text_output4.splitlines()[-1] if actual_text_output4 else False, f"Expression result '20' not found. Got: '{actual_text_output4}'"
+            tail4 = actual_text_output4[actual_text_output4.rfind('\n') + 1:]
+            assert "Result: 20" in actual_text_output4 or "Out[1]: 20" in actual_text_output4 or "20" in tail4 if actual_text_output4 else False, f"Expression result '20' not found. Got: '{actual_text_output4}'"
             print("Test 6 PASSED.")
 
             print("\n---------------------------------")
@@ -143,6 +146,69 @@ async def main():
             assert "Hello, FastMCP!" in actual_text_output5, f"Function output not found. Got: '{actual_text_output5}'"
             print("Test 7 PASSED: Multi-line function works correctly.")
 
+            # 8. Test batched commands in a single tool call
+            print("\n--- Test 8: 'send_commands' with a batch of commands ---")
+            commands6 = ["a = 3", "print(a * 7)", "undefined_name", "print('after error')"]
+            print(f"Sending commands: {commands6}")
+            result6 = await client.call_tool("send_commands", {"commands": commands6})
+            actual_text_output6 = ""
+            if isinstance(result6, list) and len(result6) > 0 and hasattr(result6[0], 'text'):
+                actual_text_output6 = "\n".join(item.text for item in result6 if hasattr(item, 'text'))
+            elif hasattr(result6, 'text'):
+                actual_text_output6 = result6.text
+            else:
+                print(f"WARNING: result6 is not as expected. Type: {type(result6)}, Value: {result6}")
+
+            print(f"Result of batched commands:\n{actual_text_output6}")
+            assert "21" in actual_text_output6, f"Batched print output '21' not found. Got: '{actual_text_output6}'"
+            assert "NameError" in actual_text_output6, f"NameError for the failing command not found. Got: '{actual_text_output6}'"
+            assert "after error" in actual_text_output6, f"Command after the failing one did not run. Got: '{actual_text_output6}'"
+            print("Test 8 PASSED: Batched commands run in order and continue past errors.")
+
+            # 9. Test chained commands where a call consumes an earlier call's result
+            print("\n--- Test 9: 'send_chained_commands' with input_from ---")
+            calls7 = [
+                {"code": "6 * 7"},
+                {"code": "answer + 1", "input_from": 0, "var": "answer"},
+                {"code": "1 / 0"},
+                {"code": "__prev", "input_from": 2},
+                {"code": "print('hi')"},
+                {"code": "__prev", "input_from": 4},
+            ]
+            print(f"Sending calls: {calls7}")
+            result7 = await client.call_tool("send_chained_commands", {"calls": calls7})
+            actual_text_output7 = ""
+            if isinstance(result7, list) and len(result7) > 0 and hasattr(result7[0], 'text'):
+                actual_text_output7 = "\n".join(item.text for item in result7 if hasattr(item, 'text'))
+            elif hasattr(result7, 'text'):
+                actual_text_output7 = result7.text
+            else:
+                print(f"WARNING: result7 is not as expected. Type: {type(result7)}, Value: {result7}")
+
+            print(f"Result of chained commands:\n{actual_text_output7}")
+            assert "Result: 43" in actual_text_output7, f"Chained result '43' not found. Got: '{actual_text_output7}'"
+            assert "Status: skipped" in actual_text_output7, f"Dependent of the failing call was not skipped. Got: '{actual_text_output7}'"
+            assert "produced no result value" in actual_text_output7, f"Dependent of a valueless call was not skipped. Got: '{actual_text_output7}'"
+            print("Test 9 PASSED: Chained calls receive earlier results and skip after failures or missing values.")
+
+            # 10. Test that a kernel dying mid-command is reported and replaced without waiting out the timeout
+            print("\n--- Test 10: kernel dies during a command ---")
+            result8 = await client.call_tool("send_command", {"command": "import os; os._exit(1)"})
+            actual_text_output8 = ""
+            if isinstance(result8, list) and len(result8) > 0 and hasattr(result8[0], 'text'):
+                actual_text_output8 = result8[0].text
+            elif hasattr(result8, 'text'):
+                actual_text_output8 = result8.text
+            else:
+                print(f"WARNING: result8 is not as expected. Type: {type(result8)}, Value: {result8}")
+
+            print(f"Result of killing the kernel:\n{actual_text_output8}")
+            assert "Status: error_kernel_died" in actual_text_output8, f"Kernel death was not reported. Got: '{actual_text_output8}'"
+            result9 = await client.call_tool("send_command", {"command": "2 + 2"})
+            actual_text_output9 = result9[0].text if isinstance(result9, list) and result9 else getattr(result9, 'text', '')
+            assert "Result: 4" in actual_text_output9, f"Replacement kernel did not run the next command. Got: '{actual_text_output9}'"
+            print("Test 10 PASSED: A dead kernel is reported and replaced for the next command.")
+
             print("🎉 All client tests passed! 🎉")
             print("---------------------------------")
 
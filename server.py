@@ -1,15 +1,36 @@
+import argparse
+import ast
 import asyncio
 import atexit
+import keyword
+import logging
 import queue # For queue.Empty exception
-import time # Added for manual timeout management
+from contextlib import asynccontextmanager
+from typing import NamedTuple, Optional
 
 from fastmcp import FastMCP, Context
-from jupyter_client import KernelManager
+from jupyter_client.manager import AsyncKernelManager
+from pydantic import BaseModel
+
+log = logging.getLogger(__name__)
+
+# Prebuilt status lines for the common shell reply statuses
+STATUS_OK = "Status: ok"
+STATUS_ERROR = "Status: error"
+_STATUS_LINES = {"ok": STATUS_OK, "error": STATUS_ERROR}
 
 class HistoryManager:
     def __init__(self):
         self.history_file = "ipython_auto_history.py"
+        self._f = None
+        self._q = None
+        self._writer_task = None
         self._ensure_history_file()
+        try:
+            # Keep one buffered handle open instead of reopening the file per command
+            self._f = open(self.history_file, 'a')
+        except Exception as e:
+            log.warning("Could not open history file for appending: %s", e)
     
     def _ensure_history_file(self):
         """Ensure history file exists with proper header"""
@@ -18,68 +39,238 @@ class HistoryManager:
                 if f.tell() == 0:  # File is empty
                     f.write("# Automatic IPython Command History\n")
         except Exception as e:
-            print(f"Warning: Could not initialize history file: {e}")
+            log.warning("Could not initialize history file: %s", e)
 
     def save_command(self, command):
-        """Append a command to history file"""
+        """Queue a command for the background writer to append to the history file"""
+        if self._f is None or command.startswith(('get_ipython', '%')) or not command.strip():
+            return
+        if self._writer_task is None:
+            # Created lazily so the queue and task belong to the server's running loop
+            self._q = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer())
+        self._q.put_nowait(command)
+
+    async def _writer(self):
+        """Drains queued commands in order, flushing once the backlog is empty"""
+        while True:
+            command = await self._q.get()
+            try:
+                self._f.write(command + '\n')
+                if self._q.empty():
+                    self._f.flush()
+            except Exception as e:
+                log.warning("Could not save command to history: %s", e)
+
+    def close(self):
+        """Stop the writer, persist any commands still queued, and close the file"""
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        if self._f is None:
+            return
         try:
-            with open(self.history_file, 'a') as f:
-                if not command.startswith(('get_ipython', '%')) and command.strip():
-                    f.write(f"{command}\n")
+            while self._q is not None and not self._q.empty():
+                self._f.write(self._q.get_nowait() + '\n')
+            self._f.close()
         except Exception as e:
-            print(f"Warning: Could not save command to history: {e}")
+            log.warning("Could not flush history file: %s", e)
+        self._f = None
+
+history_manager = HistoryManager()
 
 # Global kernel manager and client
 km = None
 kc = None
+# A started, ready kernel kept aside so a dead kernel is swapped out without a cold start
+_standby = None
+_standby_task = None
+# Background shutdowns of kernels replaced by clear_kernel, kept referenced until they finish
+_retiring_tasks = set()
+# Set when a dead kernel was replaced; reported once in the next command's output
+_restart_notice = None
+# Set once the kernel client is connected; cleared while the watchdog recovers it.
+# Module-level asyncio primitives are safe from Python 3.10, where they bind to a loop on first use.
+kc_ready = asyncio.Event()
+_watchdog_task = None
+# Number of server lifespans entered; the kernel lives while any is active
+_lifespan_sessions = 0
+# Held while a batch runs so concurrent tool calls don't consume each other's replies
+kernel_lock = asyncio.Lock()
+# Streamed partial output is batched into one notification per interval (seconds) or line count
+PARTIAL_OUTPUT_INTERVAL = 0.1
+PARTIAL_OUTPUT_MAX_LINES = 200
+# Seconds each command may run before its shell reply is treated as timed out (--command-timeout)
+shell_reply_timeout = 20.0
+# Shell replies are awaited in slices of this many seconds, checking between them that the kernel is alive
+KERNEL_ALIVE_CHECK_INTERVAL = 1.0
 
-def start_ipython_kernel():
-    """Starts and initializes the IPython kernel and client."""
-    global km, kc
-    if km and km.is_alive():
-        print("IPython kernel already running.")
+async def _launch_kernel():
+    """Starts a kernel process and a connected client, returning (manager, client)."""
+    # The async manager awaits the kernel launch, and its AsyncKernelClient awaits replies
+    # directly on the event loop instead of a worker thread.
+    manager = AsyncKernelManager()
+    client = None
+    try:
+        await manager.start_kernel()
+        log.info("IPython kernel process started.")
+        
+        client = manager.client()
+        client.start_channels()
+        log.info("IPython kernel client channels started.")
+        
+        await client.wait_for_ready(timeout=30)
+    except BaseException as e:
+        # Also runs on cancellation (e.g. a standby launch at server exit) so no kernel is orphaned
+        if client:
+            client.stop_channels()
+        if manager.has_kernel:
+            await manager.shutdown_kernel(now=True)
+        if isinstance(e, RuntimeError):
+            log.warning("Timeout waiting for IPython kernel to be ready.")
+            raise Exception("Failed to connect to IPython kernel in time.")
+        raise
+    return manager, client
+
+async def start_ipython_kernel():
+    """Starts and initializes the IPython kernel and client, promoting the standby kernel if one is ready."""
+    global km, kc, _standby, _restart_notice
+    if km and await km.is_alive():
+        log.info("IPython kernel already running.")
         return
 
-    print("Starting IPython kernel...")
-    km = KernelManager()
-    km.start_kernel()
-    print("IPython kernel process started.")
-    
-    kc = km.client()
-    kc.start_channels()
-    print("IPython kernel client channels started.")
-    
+    if km is not None:
+        # Replacing a kernel that died; its namespace is gone, so tell the next caller
+        _restart_notice = "Warning: The IPython kernel stopped and was replaced. Previously defined variables are gone."
+    standby, _standby = _standby, None
+    if standby and await standby[0].is_alive():
+        km, kc = standby
+        log.info("Promoted standby IPython kernel.")
+    else:
+        log.info("Starting IPython kernel...")
+        km, kc = await _launch_kernel()
+    log.info("IPython kernel client connected and ready.")
+    kc_ready.set()
+
+async def _fill_standby():
+    """Starts a spare kernel in the background for start_ipython_kernel to promote."""
+    global _standby
     try:
-        kc.wait_for_ready(timeout=30)
-        print("IPython kernel client connected and ready.")
-    except RuntimeError:
-        print("Timeout waiting for IPython kernel to be ready.")
-        shutdown_ipython_kernel()
-        raise Exception("Failed to connect to IPython kernel in time.")
-
-def shutdown_ipython_kernel():
-    """Shuts down the IPython kernel and client."""
-    global km, kc
-    print("Attempting to shutdown IPython kernel...")
+        _standby = await _launch_kernel()
+        log.info("Standby IPython kernel ready.")
+    except Exception as e:
+        log.warning("Failed to start standby IPython kernel: %s", e)
+
+def _ensure_standby():
+    """Schedules a standby kernel launch unless one is ready or already starting."""
+    global _standby_task
+    if _standby is None and (_standby_task is None or _standby_task.done()):
+        _standby_task = asyncio.create_task(_fill_standby())
+
+async def _retire_kernel(manager, client):
+    """Shuts down a kernel that was swapped out of service."""
+    try:
+        if client:
+            client.stop_channels()
+        if await manager.is_alive():
+            await manager.shutdown_kernel(now=True)
+            log.info("Replaced IPython kernel process terminated.")
+    except Exception as e:
+        log.warning("Failed to shut down replaced IPython kernel: %s", e)
+
+async def shutdown_ipython_kernel():
+    """Shuts down the IPython kernel and client, and the standby kernel if one is running."""
+    global km, kc, _standby
+    log.info("Attempting to shutdown IPython kernel...")
+    kc_ready.clear()
     if kc:
         if kc.channels_running:
             kc.stop_channels()
-            print("IPython kernel client channels stopped.")
+            log.info("IPython kernel client channels stopped.")
         kc = None
     
     if km:
-        if km.is_alive():
-            km.shutdown_kernel(now=True)
-            print("IPython kernel shutdown signal sent.")
-            try:
-                km.wait(timeout=5)
-                print("IPython kernel process terminated.")
-            except TimeoutError:
-                print("Timeout waiting for kernel process to terminate.")
+        if await km.is_alive():
+            # shutdown_kernel waits for the process to exit, killing it if it lingers
+            await km.shutdown_kernel(now=True)
+            log.info("IPython kernel process terminated.")
         km = None
-    print("IPython kernel shutdown process complete.")
 
-mcp = FastMCP("IPython Backend MCP Server 🚀")
+    if _standby:
+        standby_km, standby_kc = _standby
+        _standby = None
+        standby_kc.stop_channels()
+        if await standby_km.is_alive():
+            await standby_km.shutdown_kernel(now=True)
+            log.info("Standby IPython kernel process terminated.")
+    log.info("IPython kernel shutdown process complete.")
+
+async def _recover_kernel():
+    """Reconnects the client or replaces a dead kernel; the caller holds kernel_lock."""
+    global kc
+    kc_ready.clear()
+    try:
+        if km and await km.is_alive() and kc:
+            log.warning("Kernel client channels were not running. Restarting them.")
+            kc.start_channels()
+            await kc.wait_for_ready(timeout=10)
+            kc_ready.set()
+        else:
+            log.warning("IPython kernel is not running. Replacing it.")
+            if kc:
+                kc.stop_channels()
+                kc = None
+            await start_ipython_kernel()
+            _ensure_standby()
+    except Exception as e:
+        log.warning("Failed to recover IPython kernel: %s", e)
+
+async def _kernel_healthy():
+    """Whether the active kernel process is alive and its client channels are running."""
+    return bool(km and await km.is_alive() and kc and kc.channels_running)
+
+async def _kernel_watchdog(interval: float = 5.0):
+    """Periodically checks the kernel and reconnects or replaces it when it is unhealthy."""
+    _ensure_standby()
+    while True:
+        await asyncio.sleep(interval)
+        # Wait for any running batch instead of skipping the check, so a busy server still recovers
+        async with kernel_lock:
+            if not await _kernel_healthy():
+                await _recover_kernel()
+
+def _ensure_watchdog():
+    """Starts the kernel watchdog on the server's event loop unless it is already running."""
+    global _watchdog_task
+    if _watchdog_task is None:
+        _watchdog_task = asyncio.create_task(_kernel_watchdog())
+
+@asynccontextmanager
+async def kernel_lifespan(server):
+    """
+    Starts the kernel, watchdog and standby on the server's own event loop, and stops them
+    when the last session using the server ends.
+    """
+    global _lifespan_sessions, _watchdog_task
+    if _lifespan_sessions == 0:
+        await start_ipython_kernel()
+        _ensure_watchdog()
+    _lifespan_sessions += 1
+    try:
+        yield
+    finally:
+        _lifespan_sessions -= 1
+        if _lifespan_sessions == 0:
+            # Cancelling a standby launch makes _launch_kernel shut down what it already spawned
+            tasks = [task for task in (_watchdog_task, _standby_task) if task]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*_retiring_tasks, return_exceptions=True)
+            _watchdog_task = None
+            await shutdown_ipython_kernel()
+
+mcp = FastMCP("IPython Backend MCP Server 🚀", lifespan=kernel_lifespan)
 
 # SymPy Example Usage (uncomment to test):
 #  1. Symbolic variables: `x, y = symbols('x y')`
@@ -88,165 +279,431 @@ mcp = FastMCP("IPython Backend MCP Server 🚀")
 #  4. Pretty printing: `init_printing()`
 #  5. Matrices: `Matrix([[1, 2], [3, 4]])`
 
-@mcp.tool()
-async def send_command(command: str, ctx: Context) -> str:
+class CommandResult(NamedTuple):
+    """Outcome of one command: shell reply status, execution count (when ok), and formatted output."""
+    status: str
+    execution_count: Optional[int]
+    output: str
+    has_result: bool = False # Whether the kernel published an execute_result (an Out value)
+
+class BatchCall(BaseModel):
+    """One cell of a chained batch; may take the result of an earlier cell as input."""
+    code: str
+    input_from: Optional[int] = None # Index of the call whose result this call receives
+    var: Optional[str] = None # Name the input is bound to in the kernel (default: __prev)
+
+async def _execute_commands(commands: list[str], ctx: Context, history: Optional[list[str]] = None) -> list[CommandResult]:
     """
-    Executes a Python command in the IPython kernel and returns its output.
-    Output includes status, stdout, stderr, and execution results.
+    Submits every command to the kernel back-to-back, then drains IOPub and
+    shell replies for all of them at once. Returns one result per command.
+    `history` overrides what is saved to the history file, for callers that wrap user code.
     """
-    global kc, km
-    if not kc or not km or not km.is_alive():
-        await ctx.error("IPython kernel is not running or client not connected.")
+    if not kc_ready.is_set():
+        await ctx.warning("IPython kernel is not ready yet. Waiting for it to come back...")
         try:
-            await ctx.info("Attempting to restart IPython kernel...")
-            start_ipython_kernel()
-            await ctx.info("IPython kernel restarted. Please try the command again.")
-            return "Error: IPython kernel was not running. It has been restarted. Please try your command again."
-        except Exception as e:
-            await ctx.error(f"Failed to restart IPython kernel: {e}")
-            return f"Error: IPython kernel not available and failed to restart: {e}"
+            await asyncio.wait_for(kc_ready.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            await ctx.error("IPython kernel did not become ready in time.")
+            return [CommandResult("error_kernel_unavailable", None, "Error: IPython kernel is not available. It is being restarted; please try your command again.")] * len(commands)
 
-    # Initialize history manager if not exists
-    if not hasattr(send_command, '_history_manager'):
-        send_command._history_manager = HistoryManager()
-    
-    # Save command to history before execution
-    send_command._history_manager.save_command(command)
-    
-    await ctx.info(f"Executing command in IPython: {command}")
-    
-    if not kc.channels_running:
-        await ctx.warn("Kernel client channels were not running. Restarting them.")
-        kc.start_channels()
-        try:
-            await asyncio.to_thread(kc.wait_for_ready, timeout=10)
-        except RuntimeError:
-            await ctx.error("Failed to re-establish connection with kernel after channel restart.")
-            return "Error: Failed to ensure kernel client readiness."
+    for command in commands if history is None else history:
+        # Save command to history before execution
+        history_manager.save_command(command)
+        log.debug("Executing command in IPython: %s", command)
 
-    msg_id = await asyncio.to_thread(kc.execute, command)
-    outputs = []
-    
-    # IOPub Message Processing Loop
-    iopub_timeout_duration = 10.0 # Overall timeout in seconds for IOPub messages for this command
-    iopub_start_time = time.monotonic()
-    
-    await ctx.info(f"DEBUG: Starting IOPub message polling for msg_id: {msg_id} (overall timeout: {iopub_timeout_duration}s)")
+    async with kernel_lock:
+        return await _run_batch(commands, ctx)
+
+async def _run_batch(commands: list[str], ctx: Context) -> list[CommandResult]:
+    """Runs one batch on the active kernel; the caller holds kernel_lock."""
+    global _restart_notice
+    if not await _kernel_healthy():
+        # Recover here rather than waiting for the watchdog, so the next call never hits a dead kernel
+        await _recover_kernel()
+        if not kc_ready.is_set():
+            await ctx.error("IPython kernel is not running and could not be recovered.")
+            return [CommandResult("error_kernel_unavailable", None, "Error: IPython kernel is not available and could not be restarted.")] * len(commands)
+
+    restart_notice, _restart_notice = _restart_notice, None
+    if restart_notice:
+        await ctx.warning(restart_notice)
+
+    # Pipeline all execute_requests; the kernel runs them in order. stop_on_error=False keeps
+    # a failing command from aborting the rest of the batch.
+    msg_ids = [kc.execute(command, stop_on_error=False) for command in commands]
+    outputs = {msg_id: [] for msg_id in msg_ids}
+    positions = {msg_id: f"command {i}/{len(msg_ids)}" for i, msg_id in enumerate(msg_ids, 1)}
+    pending_idle = set(msg_ids)
+    produced_result = set()
     
-    kernel_reported_idle_for_request = False
+    # IOPub messages are drained alongside the shell replies below, which bound how long we wait
+    log.debug("Starting IOPub message processing for msg_ids: %s", msg_ids)
+    iopub_task = asyncio.create_task(_drain_iopub(msg_ids, outputs, positions, pending_idle, produced_result, ctx))
 
-    while True:
-        if time.monotonic() - iopub_start_time > iopub_timeout_duration:
-            outputs.append("  (Overall timeout waiting for all IOPub messages or kernel to go idle for this request)")
-            await ctx.info(f"DEBUG: Overall IOPub timeout for msg_id {msg_id} reached.")
-            break
+    try:
+        # Shell Reply Message Processing. Replies arrive in submission order.
+        shell_replies = {}
+        received = {}
+        shell_reply_timed_out = False
+        kernel_died = False
+        for msg_id in msg_ids:
+            shell_lines = []
+            write = shell_lines.append
+            shell_reply_status = "unknown"
+            execution_count = None
+            if kernel_died:
+                shell_reply_status = "error_kernel_died"
+                write("The IPython kernel died before this command ran.")
+            elif shell_reply_timed_out:
+                # Still queued in the kernel, which runs it after the interrupted command unless it dies
+                shell_reply_status = "error_not_awaited"
+                write("Not awaited because an earlier command timed out; it may still execute in the kernel.")
+            else:
+                try:
+                    if not await _await_shell_reply(msg_id, outputs, received):
+                        kernel_died = True
+                        shell_reply_status = "error_kernel_died"
+                        write("The IPython kernel died while running this command.")
+                    else:
+                        content = received[msg_id]['content']
+                        shell_reply_status = content['status']
+
+                        if shell_reply_status == 'error':
+                            write(f"  Shell Error Name: {content.get('ename', 'N/A')}")
+                            write(f"  Shell Error Value: {content.get('evalue', 'N/A')}")
+                            tb = content.get('traceback', [])
+                            if tb:
+                                write("  Shell Traceback:")
+                                shell_lines.extend(f"    {line}" for line in tb)
+                        elif shell_reply_status == 'ok':
+                            execution_count = content.get('execution_count')
+                            write(f"  Execution Count: {content.get('execution_count', 'N/A')}")
+                except queue.Empty:
+                    shell_reply_timed_out = True
+                    shell_reply_status = "error_shell_reply_timeout"
+                    write("Timeout waiting for shell reply from IPython kernel; the command was interrupted.")
+                    # Stop the overrunning cell so it doesn't also hold up the commands and calls after it
+                    try:
+                        await km.interrupt_kernel()
+                    except Exception as e:
+                        log.warning("Failed to interrupt IPython kernel: %s", e)
+                except Exception as e:
+                    shell_reply_status = "error_shell_reply_exception"
+                    await ctx.error(f"Error getting shell reply: {e}")
+                    write(f"Exception while getting shell reply: {e}")
+            shell_replies[msg_id] = (shell_reply_status, execution_count, shell_lines)
+
+        if not (shell_reply_timed_out or kernel_died):
+            # The kernel publishes idle right after each reply, so this normally returns at once;
+            # the bound only matters if an idle message was dropped.
+            await asyncio.wait({iopub_task}, timeout=2.0)
+    finally:
+        iopub_task.cancel()
+        # Retrieve the task's outcome so a failure inside it is not reported as never retrieved
+        await asyncio.gather(iopub_task, return_exceptions=True)
+
+    if kernel_died:
+        # Promote the standby now, still under the lock, so neither this caller nor the next waits on the watchdog
+        await _recover_kernel()
+        # This batch already reports the death, so it carries the replacement notice instead of the next call
+        restart_notice = restart_notice or _restart_notice
+        _restart_notice = None
+
+    results = []
+    for msg_id in msg_ids:
+        shell_reply_status, execution_count, shell_lines = shell_replies[msg_id]
+        msg_outputs = outputs[msg_id]
+        if msg_id in pending_idle:
+            msg_outputs.append("  (Kernel did not report idle for this request)")
+        msg_outputs.extend(shell_lines)
+        status_line = _STATUS_LINES.get(shell_reply_status) or f"Status: {shell_reply_status}"
+        results.append(CommandResult(shell_reply_status, execution_count, "\n".join(filter(None, (status_line, restart_notice, *msg_outputs))),
+                                     msg_id in produced_result))
+        restart_notice = None # Only the first command of the batch carries it
+            
+    return results
 
+async def _await_shell_reply(msg_id, outputs, received) -> bool:
+    """
+    Reads shell replies into `received` until msg_id's arrives, for up to shell_reply_timeout.
+    Returns False if the kernel died first; raises queue.Empty on timeout.
+    """
+    loop = asyncio.get_running_loop()
+    # Each command gets the full budget, counted from when the previous one replied
+    deadline = loop.time() + shell_reply_timeout
+    while msg_id not in received:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise queue.Empty
+        try:
+            shell_reply = await kc.get_shell_msg(timeout=min(remaining, KERNEL_ALIVE_CHECK_INTERVAL))
+        except queue.Empty:
+            if not await km.is_alive():
+                return False
+            continue
+        parent_id = shell_reply['parent_header'].get('msg_id')
+        if parent_id in outputs:
+            received[parent_id] = shell_reply
+        else:
+            # A late reply to an earlier, timed-out request; drop it so it can't shift this batch
+            log.debug("Discarded stale shell reply for msg_id %s", parent_id)
+    return True
+
+async def _drain_iopub(msg_ids, outputs, positions, pending_idle, produced_result, ctx: Context):
+    """Collects IOPub output for each msg_id until the kernel reports idle for all of them."""
+    # Bound once per command, so each matching message costs a single dict lookup
+    appenders = {msg_id: outputs[msg_id].append for msg_id in msg_ids}
+    # Output lines waiting to be forwarded to the client as one notification
+    partial = []
+    loop = asyncio.get_running_loop()
+    last_sent = loop.time()
+    while pending_idle:
+        if partial and (loop.time() - last_sent >= PARTIAL_OUTPUT_INTERVAL or len(partial) >= PARTIAL_OUTPUT_MAX_LINES):
+            # Forward output as it arrives so long-running cells show progress before idle
+            try:
+                await ctx.info("Partial output:\n" + "\n".join(partial))
+            except Exception as e:
+                # A failed notification (e.g. the client went away) must not stop collecting output
+                log.warning("Failed to forward partial output: %s", e)
+            partial.clear()
+            last_sent = loop.time()
         try:
-            # Poll with a short timeout.
-            iopub_msg = await asyncio.to_thread(kc.get_iopub_msg, timeout=0.5) 
+            # While lines are buffered, wake up in time to forward them even if the cell goes quiet
+            wait = max(0.0, last_sent + PARTIAL_OUTPUT_INTERVAL - loop.time()) if partial else None
+            iopub_msg = await kc.get_iopub_msg(timeout=wait)
 
-            if iopub_msg['parent_header'].get('msg_id') == msg_id:
+            msg_id = iopub_msg['parent_header'].get('msg_id')
+            write = appenders.get(msg_id)
+            if write is not None:
                 msg_type = iopub_msg['header']['msg_type']
                 content = iopub_msg['content']
-                await ctx.info(f"DEBUG: Received matching IOPub msg_type: {msg_type} for msg_id: {msg_id}")
+                log.debug("Received matching IOPub msg_type: %s for msg_id: %s", msg_type, msg_id)
 
                 if msg_type == 'status':
                     exec_state = content['execution_state']
-                    outputs.append(f"  Kernel Status: {exec_state}")
+                    write(f"  Kernel Status: {exec_state}")
                     if exec_state == 'idle':
-                        await ctx.info(f"DEBUG: Kernel reported idle for msg_id {msg_id}. Will continue polling until overall timeout for any trailing messages.")
-                        kernel_reported_idle_for_request = True 
-                        # We don't break here, to allow collection of trailing messages.
+                        # The kernel publishes idle last for a request, so nothing trails it.
+                        log.debug("Kernel reported idle for msg_id %s.", msg_id)
+                        pending_idle.discard(msg_id)
                 elif msg_type == 'stream':
-                    outputs.append(f"  {content['name'].capitalize()}: {content['text'].strip()}")
+                    line = f"  {content['name'].capitalize()}: {content['text'].strip()}"
+                    write(line)
+                    partial.append(f"({positions[msg_id]}):{line}")
                 elif msg_type == 'execute_result':
+                    produced_result.add(msg_id)
                     data = content.get('data', {})
                     text_plain = data.get('text/plain', '')
                     if text_plain:
-                        outputs.append(f"  Result: {text_plain.strip()}")
+                        line = f"  Result: {text_plain.strip()}"
+                        write(line)
+                        partial.append(f"({positions[msg_id]}):{line}")
                     else:
-                        outputs.append(f"  Execute_Result (no text/plain, available data keys: {list(data.keys()) if data else 'data field missing or empty'})")
+                        write(f"  Execute_Result (no text/plain, available data keys: {list(data.keys()) if data else 'data field missing or empty'})")
                 elif msg_type == 'display_data':
-                     outputs.append(f"  Display Data: {content['data'].get('text/plain', 'No plain text data').strip()}")
+                     write(f"  Display Data: {content['data'].get('text/plain', 'No plain text data').strip()}")
                 elif msg_type == 'error': # This is an IOPub error message
-                    outputs.append(f"  IOPub Error: {content.get('ename', 'N/A')} - {content.get('evalue', 'N/A')}")
+                    write(f"  IOPub Error: {content.get('ename', 'N/A')} - {content.get('evalue', 'N/A')}")
                     tb = content.get('traceback', [])
                     if tb:
-                        outputs.append("  IOPub Traceback:")
-                        outputs.extend([f"    {line}" for line in tb])
-            else:
-                await ctx.info(f"DEBUG: Ignored IOPub msg_type: {iopub_msg['header']['msg_type']} for parent_id: {iopub_msg['parent_header'].get('msg_id')} (current msg_id: {msg_id})")
+                        write("  IOPub Traceback:")
+                        outputs[msg_id].extend(f"    {line}" for line in tb)
+            elif log.isEnabledFor(logging.DEBUG):
+                log.debug("Ignored IOPub msg_type: %s for parent_id: %s (current msg_ids: %s)",
+                          iopub_msg['header']['msg_type'], msg_id, msg_ids)
         
-        except queue.Empty: 
-            await ctx.info(f"DEBUG: queue.Empty on get_iopub_msg for msg_id {msg_id}. Continuing poll if overall timeout not met.")
-            if kernel_reported_idle_for_request:
-                # If kernel has reported idle for this request, and now the queue is empty, 
-                # it's safer to assume all messages for *this request* are done.
-                await ctx.info(f"DEBUG: Kernel was idle and IOPub queue is now empty. Ending IOPub loop for msg_id {msg_id}.")
-                break
-            await asyncio.sleep(0.1) # Brief pause to prevent tight loop if kernel is slow to respond but not yet idle for request.
-            continue 
+        except queue.Empty:
+            continue # Time to forward the buffered partial output
         except Exception as e:
             await ctx.error(f"Error processing IOPub message: {e}")
-            outputs.append(f"Exception while processing IOPub message: {e}")
-            break
-            
-    # Shell Reply Message Processing (after IOPub loop)
-    shell_reply_status = "unknown"
+            for msg_id in pending_idle:
+                outputs[msg_id].append(f"Exception while processing IOPub message: {e}")
+            pending_idle.clear()
+
+@mcp.tool()
+async def send_command(command: str, ctx: Context) -> str:
+    """
+    Executes a Python command in the IPython kernel and returns its output.
+    Output includes status, stdout, stderr, and execution results.
+    """
+    return (await _execute_commands([command], ctx))[0].output
+
+@mcp.tool()
+async def send_commands(commands: list[str], ctx: Context) -> list[str]:
+    """
+    Executes several Python commands in the IPython kernel in one call, in order.
+    Returns one output per command, formatted like send_command's output.
+    A failing command does not stop the ones after it.
+    """
+    return [result.output for result in await _execute_commands(commands, ctx)]
+
+def _result_expression(code: str) -> Optional[str]:
+    """Source of the trailing expression IPython reports as a cell's Out value, if the cell ends in one."""
     try:
-        shell_reply = await asyncio.to_thread(kc.get_shell_msg, timeout=10) 
-        if shell_reply['parent_header'].get('msg_id') == msg_id:
-            content = shell_reply['content']
-            shell_reply_status = content['status']
-            outputs.insert(0, f"Status: {shell_reply_status}") 
-
-            if shell_reply_status == 'error':
-                outputs.append(f"  Shell Error Name: {content.get('ename', 'N/A')}")
-                outputs.append(f"  Shell Error Value: {content.get('evalue', 'N/A')}")
-                tb = content.get('traceback', [])
-                if tb:
-                    outputs.append("  Shell Traceback:")
-                    outputs.extend([f"    {line}" for line in tb])
-            elif shell_reply_status == 'ok':
-                outputs.append(f"  Execution Count: {content.get('execution_count', 'N/A')}")
-        else:
-            outputs.insert(0, f"Status: error_shell_reply_mismatch")
-            outputs.append(f"Shell reply (msg_id {shell_reply['parent_header'].get('msg_id')}) was not for the current command (msg_id {msg_id}).")
-    except queue.Empty:
-        outputs.insert(0, f"Status: error_shell_reply_timeout")
-        outputs.append("Timeout waiting for shell reply from IPython kernel.")
-    except Exception as e:
-        outputs.insert(0, f"Status: error_shell_reply_exception")
-        await ctx.error(f"Error getting shell reply: {e}")
-        outputs.append(f"Exception while getting shell reply: {e}")
-            
-    return "\n".join(filter(None, outputs))
+        body = ast.parse(code).body
+    except SyntaxError: # e.g. cells using IPython magics
+        return None
+    if body and isinstance(body[-1], ast.Expr):
+        return ast.get_source_segment(code, body[-1].value)
+    return None
+
+@mcp.tool()
+async def send_chained_commands(calls: list[BatchCall], ctx: Context) -> list[str]:
+    """
+    Executes a batch of cells where a cell can consume the result of an earlier one.
+    Set `input_from` to the index of another call to receive its result (its Out value)
+    as `__prev`, or under the name given in `var`. Independent cells are submitted together;
+    dependents run once their inputs are done. A call whose input failed, or produced no
+    value, is skipped. `var` must be a valid Python identifier.
+    Returns one output per call, in call order.
+    """
+    results = [None] * len(calls)
+
+    # Reject references that can never be satisfied before planning layers
+    for index, call in enumerate(calls):
+        if call.input_from is not None and not (0 <= call.input_from < len(calls) and call.input_from != index):
+            results[index] = CommandResult("error_invalid_input_from", None,
+                                           f"Status: error_invalid_input_from\n  input_from {call.input_from} does not refer to another call in this batch.")
+        elif call.var is not None and (not call.var.isidentifier() or keyword.iskeyword(call.var)):
+            results[index] = CommandResult("error_invalid_var", None,
+                                           f"Status: error_invalid_var\n  var {call.var!r} is not a valid Python identifier.")
+
+    while any(result is None for result in results):
+        # Next layer: every unfinished call whose input (if any) has finished
+        layer = [index for index, call in enumerate(calls)
+                 if results[index] is None and (call.input_from is None or results[call.input_from] is not None)]
+        if not layer:
+            for index, result in enumerate(results):
+                if result is None:
+                    results[index] = CommandResult("error_dependency_cycle", None,
+                                                   "Status: error_dependency_cycle\n  This call's input_from chain forms a cycle.")
+            break
+
+        runnable = []
+        for index in layer:
+            call = calls[index]
+            if call.input_from is None:
+                runnable.append((index, call.code, call.code))
+                continue
+            source = results[call.input_from]
+            if source.status != 'ok':
+                results[index] = CommandResult("skipped", None,
+                                               f"Status: skipped\n  Input call {call.input_from} finished with status {source.status}.")
+                continue
+            if not source.has_result:
+                results[index] = CommandResult("skipped", None,
+                                               f"Status: skipped\n  Input call {call.input_from} produced no result value to pass on.")
+                continue
+            name = call.var or '__prev'
+            # Out[N] numbering differs on replay, so history re-evaluates the source's result expression
+            expression = _result_expression(calls[call.input_from].code)
+            replay_binding = f"{name} = ({expression})" if expression else f"# {name} = result of call {call.input_from} (Out[{source.execution_count}])"
+            runnable.append((index, f"{name} = Out[{source.execution_count}]\n{call.code}", f"{replay_binding}\n{call.code}"))
+
+        if runnable:
+            layer_results = await _execute_commands([code for _, code, _ in runnable], ctx,
+                                                    history=[history_code for _, _, history_code in runnable])
+            for (index, _, _), result in zip(runnable, layer_results):
+                results[index] = result
+
+    return [result.output for result in results]
 
 @mcp.tool()
 async def clear_kernel(ctx: Context) -> str:
     """
-    Clears all variables and resets the IPython kernel environment using '%reset -f'.
+    Clears all variables by switching to a fresh IPython kernel, which guarantees a pristine namespace.
+    Uses the warm standby kernel when one is ready, otherwise restarts the kernel.
+    Falls back to '%reset -f' if the restart fails.
     """
-    await ctx.info("Attempting to clear IPython kernel environment with '%reset -f'...")
-    reset_command_output = await send_command("%reset -f", ctx) 
+    global km, kc, _standby, _restart_notice
+    await ctx.info("Attempting to clear IPython kernel environment by switching to a fresh kernel...")
+    try:
+        async with kernel_lock:
+            kc_ready.clear()
+            try:
+                if _standby and await _standby[0].is_alive():
+                    # Rotate to the standby instead of cold-restarting; the old kernel shuts down in the background
+                    retired = (km, kc)
+                    (km, kc), _standby = _standby, None
+                    _ensure_standby()
+                    if retired[0]:
+                        task = asyncio.create_task(_retire_kernel(*retired))
+                        _retiring_tasks.add(task)
+                        task.add_done_callback(_retiring_tasks.discard)
+                    outcome = "switched to the standby kernel"
+                else:
+                    await km.restart_kernel(now=True)
+                    await kc.wait_for_ready(timeout=10)
+                    outcome = "kernel restarted"
+                # The caller asked for a fresh namespace, so a pending replacement warning is moot
+                _restart_notice = None
+            finally:
+                if km and await km.is_alive():
+                    kc_ready.set()
+        return f"IPython kernel environment cleared successfully ({outcome})."
+    except Exception as e:
+        await ctx.warning(f"Kernel restart failed ({e}); falling back to '%reset -f'.")
+
+    reset_command_output = (await _execute_commands(["%reset -f"], ctx))[0].output
     
     # Check the actual output from send_command for success/failure
-    if "Status: ok" in reset_command_output and "error" not in reset_command_output.lower():
+    if STATUS_OK in reset_command_output and "error" not in reset_command_output.lower():
         return f"IPython kernel environment cleared successfully.\nDetails:\n{reset_command_output}"
     else:
         return f"IPython kernel clear command finished with potential issues.\nDetails:\n{reset_command_output}"
 
+def _shutdown_at_exit():
+    """Fallback for when the server lifespan did not get to shut the kernel down."""
+    if km is None and _standby is None:
+        return
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(shutdown_ipython_kernel())
+    finally:
+        loop.close()
+
+def install_uvloop():
+    """Uses uvloop's event loop for the server when it is available."""
+    try:
+        import uvloop
+    except ImportError:
+        log.info("uvloop not available, using the default asyncio event loop.")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="FastMCP server backed by an IPython kernel.")
+    parser.add_argument("--transport", choices=["stdio", "sse", "streamable-http"], default="stdio",
+                        help="MCP transport to serve on (default: stdio)")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind for network transports")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind for network transports")
+    parser.add_argument("--command-timeout", type=float, default=shell_reply_timeout,
+                        help=f"Seconds to wait for each command to finish (default: {shell_reply_timeout:g})")
+    return parser.parse_args()
+
 def main():
-    atexit.register(shutdown_ipython_kernel)
+    global shell_reply_timeout
+    args = parse_args()
+    shell_reply_timeout = args.command_timeout
+    # Log to stderr so kernel lifecycle messages never mix with the stdio transport on stdout
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    atexit.register(_shutdown_at_exit)
+    atexit.register(history_manager.close)
+    install_uvloop()
     try:
-        start_ipython_kernel()
-        print("Attempting to run FastMCP server with IPython backend...")
-        mcp.run() 
+        # The kernel is started by kernel_lifespan on the server's own event loop
+        log.info("Attempting to run FastMCP server with IPython backend...")
+        if args.transport == "stdio":
+            mcp.run()
+        else:
+            # Both asyncio and uvloop enable TCP_NODELAY on every accepted TCP connection,
+            # so small JSON-RPC frames are not held back by Nagle's algorithm.
+            mcp.run(transport=args.transport, host=args.host, port=args.port)
     except Exception as e:
-        print(f"Error running FastMCP server or starting kernel: {e}")
+        log.error("Error running FastMCP server or starting kernel: %s", e)
     finally:
-        print("FastMCP server run loop finished or error occurred.")
-        print("Exiting application. Kernel shutdown will be handled by atexit.")
+        log.info("FastMCP server run loop finished or error occurred.")
+        log.info("Exiting application.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
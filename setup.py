@@ -13,6 +13,8 @@ setup(
     install_requires=[
         'fastmcp',
         'jupyter_client',
+        'pydantic',
+        'uvloop; sys_platform != "win32"',
         # Add any other dependencies found in server.py, e.g., asyncio, atexit, queue, time
         # These are standard library modules, so no need to list them here.
     ],
@@ -25,7 +27,7 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: System :: Shells',
     ],
-    python_requires='>=3.7',
+    python_requires='>=3.10',
     entry_points={
         'console_scripts': [
             'mcp-ipython-server=server:main',